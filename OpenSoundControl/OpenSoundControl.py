@@ -3,6 +3,7 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import time
 
 #
 # OpenSoundControl
@@ -198,9 +199,110 @@ class OpenSoundControlLogic(ScriptedLoadableModuleLogic):
     self.loggingEnabled = False
     self.pureDataProcess = None
 
+    # Send queue: messages are sent in priority order, at most maxMessagesPerTick messages in each tick.
+    # Messages of guaranteed priority classes are sent immediately, without waiting for the next tick.
+    # Messages that could not be sent within their deadline are dropped.
+    self.priorityClasses = {
+      "high": {"priority": 0, "deadlineSec": 0.02, "guaranteed": True},
+      "normal": {"priority": 1, "deadlineSec": 0.05, "guaranteed": False},
+      "low": {"priority": 2, "deadlineSec": 0.2, "guaranteed": False},
+      }
+    self.defaultPriorityClass = "normal"
+    # Priority class of addresses, key is the address suffix (e.g., "/Distance")
+    self.addressSuffixPriorityClasses = {}
+    self.addressPriorityClassCache = {}
+    # If 0 then messages are sent immediately, without using the send queue
+    self.maxMessagesPerTick = 0
+    # Key is the address, value is [content, queued time, priority class name, timestamp for latency measurement]
+    self.pendingMessages = {}
+    self.sendQueueTimer = qt.QTimer()
+    self.sendQueueTimer.setInterval(10)
+    self.sendQueueTimer.connect('timeout()', self.oscSendQueuedMessages)
+    self.resetMessageCounters()
+    self.resetSendLatencyMetrics()
+
   def setLoggingEnabled(self, enable):
     self.loggingEnabled = enable
 
+  def setAddressPriorityClass(self, addressSuffix, priorityClassName):
+    """Set priority class of all addresses that end with addressSuffix.
+    """
+    if priorityClassName not in self.priorityClasses:
+      raise ValueError("Unknown priority class: "+priorityClassName)
+    self.addressSuffixPriorityClasses[addressSuffix] = priorityClassName
+    self.addressPriorityClassCache = {}
+
+  def removeAddressPriorityClass(self, addressSuffix):
+    """Remove priority class setting of addressSuffix. Matching addresses will use the default class.
+    """
+    self.addressSuffixPriorityClasses.pop(addressSuffix, None)
+    self.addressPriorityClassCache = {}
+
+  def getAddressPriorityClass(self, address):
+    priorityClassName = self.addressPriorityClassCache.get(address)
+    if priorityClassName:
+      return priorityClassName
+    priorityClassName = self.defaultPriorityClass
+    # Longest matching suffix wins
+    matchedSuffixLength = -1
+    for addressSuffix in self.addressSuffixPriorityClasses:
+      if address.endswith(addressSuffix) and len(addressSuffix) > matchedSuffixLength:
+        priorityClassName = self.addressSuffixPriorityClasses[addressSuffix]
+        matchedSuffixLength = len(addressSuffix)
+    self.addressPriorityClassCache[address] = priorityClassName
+    return priorityClassName
+
+  def setSendQueue(self, maxMessagesPerTick, tickIntervalMsec=10):
+    """Enable send queue with the specified budget. Set maxMessagesPerTick to 0 to send all messages immediately.
+    """
+    self.maxMessagesPerTick = maxMessagesPerTick
+    self.sendQueueTimer.setInterval(tickIntervalMsec)
+    if self.maxMessagesPerTick > 0:
+      self.sendQueueTimer.start()
+    else:
+      self.sendQueueTimer.stop()
+      self.oscSendQueuedMessages()
+
+  def discardQueuedMessages(self):
+    """Remove all pending messages without sending them. They are counted as dropped.
+    """
+    for content, queuedTime, priorityClassName, timestamp in self.pendingMessages.values():
+      self.messageCounters[priorityClassName]["dropped"] += 1
+    self.pendingMessages = {}
+
+  def resetMessageCounters(self):
+    self.messageCounters = {}
+    for priorityClassName in self.priorityClasses:
+      self.messageCounters[priorityClassName] = {"sent": 0, "dropped": 0, "late": 0, "superseded": 0}
+
+  def resetSendLatencyMetrics(self):
+    self.sendLatencyCount = 0
+    self.sendLatencySum = 0.0
+    self.sendLatencyMax = 0.0
+
+  def getSendLatencyMetrics(self):
+    """Returns latency of messages that were queued with a timestamp (time from the timestamp until sending).
+    """
+    return {
+      "sentCount": self.sendLatencyCount,
+      "meanLatencySec": self.sendLatencySum / self.sendLatencyCount if self.sendLatencyCount else 0.0,
+      "maxLatencySec": self.sendLatencyMax,
+      }
+
+  def updateSendLatencyMetrics(self, timestamp):
+    if timestamp is None:
+      return
+    latency = time.perf_counter() - timestamp
+    self.sendLatencyCount += 1
+    self.sendLatencySum += latency
+    self.sendLatencyMax = max(self.sendLatencyMax, latency)
+
+  def getMessageCounters(self):
+    """Returns number of sent, dropped, late, and superseded messages for each priority class.
+    Superseded messages are pending messages that were replaced by a newer message sent to the same address.
+    """
+    return self.messageCounters
+
   def oscConnect(self, hostname="localhost", port=7400):
     logging.info("Connect to OSC server at "+hostname+":"+str(port))
     from pythonosc.udp_client import SimpleUDPClient
@@ -218,6 +320,58 @@ class OpenSoundControlLogic(ScriptedLoadableModuleLogic):
       raise RuntimeError("OSC client is not connected.")
     self.oscClient.send_message(address, content)
 
+  def oscQueueMessage(self, address, content, timestamp=None):
+    """Send message considering priority of the address and the send budget.
+    Messages of guaranteed priority classes are sent immediately, other messages are sent in the next tick.
+    If a message is already waiting to be sent to the same address then it is replaced by this newer message.
+    If timestamp (time.perf_counter() value) is specified then latency from that time until sending is measured.
+    """
+    priorityClassName = self.getAddressPriorityClass(address)
+    if self.maxMessagesPerTick <= 0 or self.priorityClasses[priorityClassName]["guaranteed"]:
+      self.oscSendMessage(address, content)
+      self.messageCounters[priorityClassName]["sent"] += 1
+      self.updateSendLatencyMetrics(timestamp)
+      return
+    if address in self.pendingMessages:
+      # Previous value is outdated, it will not be sent
+      self.messageCounters[priorityClassName]["superseded"] += 1
+    self.pendingMessages[address] = [content, time.perf_counter(), priorityClassName, timestamp]
+
+  def oscSendQueuedMessages(self, currentTime=None):
+    """Send pending messages, in the order of priority and age, within the budget of the current tick.
+    Messages that are pending for longer than their deadline are dropped before any message is sent,
+    so that the budget is not spent on stale values.
+    """
+    if not self.pendingMessages:
+      return
+    if currentTime is None:
+      currentTime = time.perf_counter()
+    lateAddresses = set()
+    for address, (content, queuedTime, priorityClassName, timestamp) in list(self.pendingMessages.items()):
+      priorityClass = self.priorityClasses[priorityClassName]
+      if (currentTime - queuedTime) <= priorityClass["deadlineSec"]:
+        continue
+      if priorityClass["guaranteed"]:
+        lateAddresses.add(address)
+      else:
+        del self.pendingMessages[address]
+        self.messageCounters[priorityClassName]["dropped"] += 1
+    budget = self.maxMessagesPerTick if self.maxMessagesPerTick > 0 else len(self.pendingMessages)
+    sortedAddresses = sorted(self.pendingMessages, key=lambda address:
+      (self.priorityClasses[self.pendingMessages[address][2]]["priority"], self.pendingMessages[address][1]))
+    for address in sortedAddresses:
+      content, queuedTime, priorityClassName, timestamp = self.pendingMessages[address]
+      if budget <= 0 and not self.priorityClasses[priorityClassName]["guaranteed"]:
+        continue
+      del self.pendingMessages[address]
+      self.oscSendMessage(address, content)
+      self.updateSendLatencyMetrics(timestamp)
+      budget -= 1
+      counters = self.messageCounters[priorityClassName]
+      counters["sent"] += 1
+      if address in lateAddresses:
+        counters["late"] += 1
+
   def getPureDataExecutablePath(self):
     if self.pureDataExecutablePath:
       return self.pureDataExecutablePath
@@ -317,6 +471,8 @@ class OpenSoundControlTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_OpenSoundControl1()
+    self.setUp()
+    self.test_OpenSoundControlSendQueue()
 
   def test_OpenSoundControl1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -353,3 +509,49 @@ class OpenSoundControlTest(ScriptedLoadableModuleTest):
     logic = OpenSoundControlLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_OpenSoundControlSendQueue(self):
+    """Check that under overload high-priority messages are always sent and stale low-priority messages are dropped.
+    """
+    self.delayDisplay("Starting the send queue test")
+    logic = OpenSoundControlLogic()
+    logic.oscConnect("localhost", 7400)
+    logic.setAddressPriorityClass("/Distance", "high")
+    logic.setAddressPriorityClass("/OrientationZ", "low")
+    logic.setSendQueue(2)
+    logic.sendQueueTimer.stop()  # ticks are triggered manually in this test
+
+    for instrumentIndex in range(5):
+      logic.oscQueueMessage("/SoundNav/Instrument{0}/OrientationZ".format(instrumentIndex), 1.0)
+      logic.oscQueueMessage("/SoundNav/Instrument{0}/Distance".format(instrumentIndex), 2.0)
+    counters = logic.getMessageCounters()
+    # High-priority messages are sent immediately, without waiting for the next tick
+    self.assertEqual(counters["high"]["sent"], 5)
+    self.assertEqual(len(logic.pendingMessages), 5)
+
+    # Newer value replaces the pending one
+    logic.oscQueueMessage("/SoundNav/Instrument0/OrientationZ", 3.0)
+    self.assertEqual(counters["low"]["superseded"], 1)
+    self.assertEqual(counters["low"]["dropped"], 0)
+
+    # Only as many low-priority messages are sent as the budget allows
+    logic.oscSendQueuedMessages(time.perf_counter())
+    self.assertEqual(counters["low"]["sent"], 2)
+    self.assertEqual(len(logic.pendingMessages), 3)
+
+    # After the deadline stale low-priority messages are dropped, even if there is budget to send them
+    logic.oscSendQueuedMessages(time.perf_counter() + 1.0)
+    self.assertEqual(counters["low"]["dropped"], 3)
+    self.assertEqual(counters["low"]["sent"], 2)
+    self.assertEqual(len(logic.pendingMessages), 0)
+    self.assertEqual(counters["high"]["dropped"], 0)
+    self.assertEqual(counters["high"]["late"], 0)
+
+    # Pending messages are not sent when they are discarded
+    logic.oscQueueMessage("/SoundNav/Instrument0/OrientationZ", 4.0)
+    logic.discardQueuedMessages()
+    self.assertEqual(counters["low"]["dropped"], 4)
+    self.assertEqual(counters["low"]["sent"], 2)
+
+    logic.setSendQueue(0)
+    self.delayDisplay('Test passed!')
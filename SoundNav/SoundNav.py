@@ -4,7 +4,10 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import math
+import platform
+import time
 import numpy as np
+from SoundNavLib import ParameterMapping, SonificationWorker
 
 #
 # SoundNav
@@ -23,6 +26,10 @@ class SoundNav(ScriptedLoadableModule):
     self.parent.contributors = ["David Black (Fraunhofer Mevis)", "Julian Hettig (Uni. Magdeburg)", "Andras Lasso (PerkLab)"]
     self.parent.helpText = """
 Send sound control messages with parameters depending on values in transforms.
+If a planned trajectory (markups line or curve) or landmarks (markups point list) are selected for an instrument
+then distance, depth, and angle relative to the trajectory and distance to the nearest landmark are sent as well.
+Sound parameters, such as frequency or tempo, can be computed from these values by transfer functions
+specified in ParameterMappings parameter of the module's parameter node.
 """
     self.parent.helpText += self.getDefaultModuleDocumentationLink()
     self.parent.acknowledgementText = """
@@ -87,7 +94,11 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
 
       nameLineEdit = qt.QLineEdit()
       instrumentLayout.addRow("Instrument name: ", nameLineEdit)
-      nameLineEdit.connect('editingFinished()', self.updateMRMLFromGUI)
+
+      directionLineEdit = qt.QLineEdit()
+      directionLineEdit.setToolTip("Direction of the instrument shaft in the instrument coordinate system (three numbers, e.g., 0 0 1)."
+        " Used for computing angle between the instrument and the planned trajectory.")
+      instrumentLayout.addRow("Instrument direction: ", directionLineEdit)
 
       instrumentSourceSelector = slicer.qMRMLNodeComboBox()
 
@@ -102,7 +113,6 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
       instrumentSourceSelector.setMRMLScene(slicer.mrmlScene)
       instrumentSourceSelector.setToolTip("Defines position and orientation of the instrument (transform or breach warning node)")
       instrumentLayout.addRow("Instrument node: ", instrumentSourceSelector)
-      instrumentSourceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateMRMLFromGUI)
 
       instrumentReferenceSelector = slicer.qMRMLNodeComboBox()
       instrumentReferenceSelector.nodeTypes = ["vtkMRMLLinearTransformNode"]
@@ -113,13 +123,36 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
       instrumentReferenceSelector.setMRMLScene(slicer.mrmlScene)
       instrumentReferenceSelector.setToolTip("Position and orientation is defined relative to this transform")
       instrumentLayout.addRow("Reference transform: ", instrumentReferenceSelector)
-      instrumentReferenceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateMRMLFromGUI)
+
+      trajectorySelector = slicer.qMRMLNodeComboBox()
+      trajectorySelector.nodeTypes = ["vtkMRMLMarkupsLineNode", "vtkMRMLMarkupsCurveNode"]
+      trajectorySelector.addEnabled = True
+      trajectorySelector.removeEnabled = True
+      trajectorySelector.noneEnabled = True
+      trajectorySelector.renameEnabled = True
+      trajectorySelector.setMRMLScene(slicer.mrmlScene)
+      trajectorySelector.setToolTip("Planned trajectory (line from entry to target point, or curve)."
+        " Distance, depth, and angle of the instrument relative to this trajectory are sent.")
+      instrumentLayout.addRow("Planned trajectory: ", trajectorySelector)
+
+      landmarksSelector = slicer.qMRMLNodeComboBox()
+      landmarksSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+      landmarksSelector.addEnabled = True
+      landmarksSelector.removeEnabled = True
+      landmarksSelector.noneEnabled = True
+      landmarksSelector.renameEnabled = True
+      landmarksSelector.setMRMLScene(slicer.mrmlScene)
+      landmarksSelector.setToolTip("Landmark or target points. Distance of the instrument from the nearest point is sent.")
+      instrumentLayout.addRow("Landmarks: ", landmarksSelector)
 
       widgets = {}
       widgets['instrumentGroupBox'] = instrumentGroupBox
       widgets['nameLineEdit'] = nameLineEdit
+      widgets['directionLineEdit'] = directionLineEdit
       widgets['instrumentSourceSelector'] = instrumentSourceSelector
       widgets['instrumentReferenceSelector'] = instrumentReferenceSelector
+      widgets['trajectorySelector'] = trajectorySelector
+      widgets['landmarksSelector'] = landmarksSelector
 
       self.instrumentWidgets.append(widgets)
 
@@ -135,8 +168,35 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
       widgets['instrumentGroupBox'].collapsed = not widgets['nameLineEdit'].text
       # Observe widget changes to update MRML node immediately (this way always up-to-date values will be saved in the scene)
       widgets['nameLineEdit'].connect('editingFinished()', self.updateMRMLFromGUI)
+      widgets['directionLineEdit'].connect('editingFinished()', self.updateMRMLFromGUI)
       widgets['instrumentSourceSelector'].connect("currentNodeChanged(vtkMRMLNode*)", self.updateMRMLFromGUI)
       widgets['instrumentReferenceSelector'].connect("currentNodeChanged(vtkMRMLNode*)", self.updateMRMLFromGUI)
+      widgets['trajectorySelector'].connect("currentNodeChanged(vtkMRMLNode*)", self.updateMRMLFromGUI)
+      widgets['landmarksSelector'].connect("currentNodeChanged(vtkMRMLNode*)", self.updateMRMLFromGUI)
+
+    #
+    # Advanced area
+    #
+    advancedCollapsibleButton = ctk.ctkCollapsibleButton()
+    advancedCollapsibleButton.text = "Advanced"
+    advancedCollapsibleButton.collapsed = True
+    self.layout.addWidget(advancedCollapsibleButton)
+    advancedFormLayout = qt.QFormLayout(advancedCollapsibleButton)
+
+    self.workerProcessCheckBox = qt.QCheckBox(" ")
+    self.workerProcessCheckBox.setToolTip("Compute and send sound parameters in a separate process."
+      " Sound feedback is then not delayed by rendering or other processing in the application."
+      " Message priorities and send budget are not applied in this mode.")
+    advancedFormLayout.addRow("Use worker process:", self.workerProcessCheckBox)
+    self.workerProcessCheckBox.connect('toggled(bool)', self.updateMRMLFromGUI)
+
+    self.latencyLabel = qt.QLabel()
+    self.latencyLabel.setToolTip("Time from instrument update until sound parameters are sent")
+    advancedFormLayout.addRow("Latency:", self.latencyLabel)
+    self.latencyUpdateTimer = qt.QTimer()
+    self.latencyUpdateTimer.setInterval(1000)
+    self.latencyUpdateTimer.connect('timeout()', self.updateLatencyLabel)
+    self.latencyUpdateTimer.start()
 
     self.parameterNodeObserverTag = parameterNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.updateGUIFromMRML)
 
@@ -164,7 +224,6 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
     wasBlocked = self.addressRootLineEdit.blockSignals(True)
     self.addressRootLineEdit.setText(parameterNode.GetParameter("AddressRoot"))
     self.addressRootLineEdit.blockSignals(wasBlocked)
-    self.addressRootLineEdit.setEnabled(not connectionActive)
 
     for instrumentIndex in range(len(self.instrumentWidgets)):
       widgets = self.instrumentWidgets[instrumentIndex]
@@ -173,6 +232,10 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
       widgets['nameLineEdit'].setText(parameterNode.GetParameter("InstrumentName"+str(instrumentIndex)))
       widgets['nameLineEdit'].blockSignals(wasBlocked)
 
+      wasBlocked = widgets['directionLineEdit'].blockSignals(True)
+      widgets['directionLineEdit'].setText(parameterNode.GetParameter("InstrumentDirection"+str(instrumentIndex)))
+      widgets['directionLineEdit'].blockSignals(wasBlocked)
+
       wasBlocked = widgets['instrumentSourceSelector'].blockSignals(True)
       widgets['instrumentSourceSelector'].setCurrentNode(parameterNode.GetNodeReference("InstrumentSource"+str(instrumentIndex)))
       widgets['instrumentSourceSelector'].blockSignals(wasBlocked)
@@ -183,12 +246,26 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
       widgets['instrumentReferenceSelector'].setEnabled(instrumentSourceNode and instrumentSourceNode.IsA("vtkMRMLTransformNode"))
       widgets['instrumentReferenceSelector'].blockSignals(wasBlocked)
 
-      widgets['instrumentGroupBox'].setEnabled(not connectionActive)
+      wasBlocked = widgets['trajectorySelector'].blockSignals(True)
+      widgets['trajectorySelector'].setCurrentNode(parameterNode.GetNodeReference("InstrumentTrajectory"+str(instrumentIndex)))
+      widgets['trajectorySelector'].setEnabled(instrumentSourceNode and instrumentSourceNode.IsA("vtkMRMLTransformNode"))
+      widgets['trajectorySelector'].blockSignals(wasBlocked)
+
+      wasBlocked = widgets['landmarksSelector'].blockSignals(True)
+      widgets['landmarksSelector'].setCurrentNode(parameterNode.GetNodeReference("InstrumentLandmarks"+str(instrumentIndex)))
+      widgets['landmarksSelector'].setEnabled(instrumentSourceNode and instrumentSourceNode.IsA("vtkMRMLTransformNode"))
+      widgets['landmarksSelector'].blockSignals(wasBlocked)
+
+    wasBlocked = self.workerProcessCheckBox.blockSignals(True)
+    self.workerProcessCheckBox.checked = slicer.util.toBool(parameterNode.GetParameter("WorkerProcessEnabled"))
+    self.workerProcessCheckBox.blockSignals(wasBlocked)
 
     self.enableConnectionCheckBox.checked = connectionActive
 
   def updateMRMLFromGUI(self):
     parameterNode = self.logic.getParameterNode()
+    # Update all parameters at once, so that observers are only notified once
+    wasModified = parameterNode.StartModify()
 
     parameterNode.SetParameter("ConnectionHostName", self.hostnameLineEdit.text)
     parameterNode.SetParameter("ConnectionPort", self.portLineEdit.text)
@@ -197,11 +274,17 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
     for instrumentIndex in range(len(self.instrumentWidgets)):
       widgets = self.instrumentWidgets[instrumentIndex]
       parameterNode.SetParameter("InstrumentName"+str(instrumentIndex), widgets['nameLineEdit'].text)
+      parameterNode.SetParameter("InstrumentDirection"+str(instrumentIndex), widgets['directionLineEdit'].text)
       parameterNode.SetNodeReferenceID("InstrumentSource"+str(instrumentIndex), widgets['instrumentSourceSelector'].currentNodeID)
       parameterNode.SetNodeReferenceID("InstrumentReference"+str(instrumentIndex), widgets['instrumentReferenceSelector'].currentNodeID)
+      parameterNode.SetNodeReferenceID("InstrumentTrajectory"+str(instrumentIndex), widgets['trajectorySelector'].currentNodeID)
+      parameterNode.SetNodeReferenceID("InstrumentLandmarks"+str(instrumentIndex), widgets['landmarksSelector'].currentNodeID)
 
+    parameterNode.SetParameter("WorkerProcessEnabled", "true" if self.workerProcessCheckBox.checked else "false")
     parameterNode.SetParameter("ConnectionActive", "true" if self.enableConnectionCheckBox.checked else "false")
 
+    parameterNode.EndModify(wasModified)
+
   def setTransmissionActive(self, state):
     parameterNode = self.logic.getParameterNode()
     parameterNode.SetParameter("ConnectionActive", "true" if state else "false")
@@ -210,6 +293,19 @@ class SoundNavWidget(ScriptedLoadableModuleWidget):
     else:
       self.logic.stopTransmission()
 
+  def updateLatencyLabel(self):
+    if not self.latencyLabel.visible:
+      return
+    metrics = self.logic.getLatencyMetrics()
+    text = "in-process: {0:.2f}ms (max {1:.2f}ms)".format(
+      metrics["inProcess"]["meanLatencySec"] * 1000, metrics["inProcess"]["maxLatencySec"] * 1000)
+    workerMetrics = metrics["worker"]
+    if workerMetrics:
+      text += "\nworker: {0:.2f}ms (max {1:.2f}ms), backlog: {2}, dropped: {3}{4}".format(
+        workerMetrics["meanLatencySec"] * 1000, workerMetrics["maxLatencySec"] * 1000,
+        workerMetrics["backlog"], workerMetrics["droppedCount"], "" if workerMetrics["running"] else " (not running)")
+    self.latencyLabel.text = text
+
 #
 # SoundNavLogic
 #
@@ -227,20 +323,101 @@ class SoundNavLogic(ScriptedLoadableModuleLogic):
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
 
-    self.instrumentNodeObserverTags = []
+    # Key is (node ID, event), value is [node, observer tag, list of instrument indices]
+    self.instrumentNodeObservations = {}
     self.instrumentOscAddress = []
+    self.parameterNodeObserverTag = None
+    # (host name, port) of the current OSC connection
+    self.oscConnectionHostPort = None
+
+    # Geometry of trajectory and landmark markups nodes, stored as numpy arrays (in world coordinate system).
+    # Key is the markups node ID. Entries are removed when the markups node is modified and recomputed on next use.
+    self.targetGeometryCache = {}
 
     import OpenSoundControl
     self.oscLogic = OpenSoundControl.OpenSoundControlLogic()
 
+    # Safety-critical values must be sent without delay even if the send budget is exceeded
+    for parameterName in ["Distance", "TrajectoryDistance", "LandmarkDistance"]:
+      self.oscLogic.setAddressPriorityClass("/"+parameterName, "high")
+    for parameterName in ["OrientationX", "OrientationY", "OrientationZ", "Orientation", "LandmarkIndex"]:
+      self.oscLogic.setAddressPriorityClass("/"+parameterName, "low")
+
     # Logging can be enabled for debugging
     #self.oscLogic.loggingEnabled = True
 
+    # Sonification worker process (if sound parameters are computed and sent from a separate process)
+    self.workerProcess = None
+    self.workerRingBuffer = None
+    self.workerInstrumentOscAddress = None
+    self.workerConnectionHostPort = None
+    self.workerSmoothingFactor = None
+    self.workerParameterMappings = None
+    self.workerStartTime = None
+    # If the worker exits too soon after it is started multiple times then it is not restarted anymore
+    self.workerNumberOfFailedStarts = 0
+    self.workerMinimumRunTimeSec = 5.0
+    self.workerMaximumNumberOfFailedStarts = 3
+    # Worker is considered stuck if it has not updated its heartbeat for this long
+    self.workerHeartbeatTimeoutSec = 2.0
+    # Maximum time for the worker process to start up and write its first heartbeat
+    self.workerStartupTimeoutSec = 30.0
+
+    # Transfer functions that compute sound parameters from navigation values
+    self.parameterMapper = None
+    self.parameterMappings = None
+    # Key is instrument index, value is [parameter value, direction vector]
+    self.instrumentDirections = {}
+    # Output names of the current mappings (they are sent with high priority)
+    self.parameterMappingOutputNames = []
+    self.workerMonitorTimer = qt.QTimer()
+    self.workerMonitorTimer.setInterval(1000)
+    self.workerMonitorTimer.connect('timeout()', self.onWorkerMonitorTimeout)
+
   def __del__(self):
     ScriptedLoadableModuleLogic.__del__(self)
+    self.removeParameterNodeObserver()
     self.removeAllInstrumentNodeObservers()
 
-  def addInstrumentNodeObservers(self):
+  def getRequiredInstrumentNodeObservations(self):
+    """Get list of nodes and events that need to be observed for the current instrument configuration.
+    Returns dict of (node ID, event) -> [node, list of instrument indices].
+    """
+    parameterNode = self.getParameterNode()
+    requiredObservations = {}
+    def addObservation(node, event, instrumentIndex):
+      key = (node.GetID(), event)
+      if key not in requiredObservations:
+        requiredObservations[key] = [node, []]
+      requiredObservations[key][1].append(instrumentIndex)
+
+    for instrumentIndex in range(int(parameterNode.GetParameter("MaxNumberOfInstruments"))):
+      instrumentName = parameterNode.GetParameter("InstrumentName"+str(instrumentIndex))
+      if not instrumentName:
+        continue
+      instrumentNode = parameterNode.GetNodeReference("InstrumentSource"+str(instrumentIndex))
+      if not instrumentNode:
+        continue
+      if instrumentNode.IsA("vtkMRMLBreachWarningNode"):
+        addObservation(instrumentNode, vtk.vtkCommand.ModifiedEvent, instrumentIndex)
+        continue
+      if not instrumentNode.IsA("vtkMRMLTransformNode"):
+        continue
+      addObservation(instrumentNode, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, instrumentIndex)
+      referenceNode = parameterNode.GetNodeReference("InstrumentReference"+str(instrumentIndex))
+      if referenceNode:
+        addObservation(referenceNode, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, instrumentIndex)
+      for targetReferenceRole in ["InstrumentTrajectory", "InstrumentLandmarks"]:
+        targetNode = parameterNode.GetNodeReference(targetReferenceRole+str(instrumentIndex))
+        if not targetNode:
+          continue
+        for event in [slicer.vtkMRMLMarkupsNode.PointAddedEvent, slicer.vtkMRMLMarkupsNode.PointRemovedEvent,
+          slicer.vtkMRMLMarkupsNode.PointModifiedEvent, slicer.vtkMRMLTransformableNode.TransformModifiedEvent]:
+          addObservation(targetNode, event, instrumentIndex)
+
+    return requiredObservations
+
+  def updateInstrumentOscAddresses(self):
     parameterNode = self.getParameterNode()
     # Address consists of several components, construct them here so that we don't need to regenerate on each update
     self.instrumentOscAddress = []
@@ -251,32 +428,88 @@ class SoundNavLogic(ScriptedLoadableModuleLogic):
     # Make sure the address root ends with /
     if addressRoot[-1:] != "/":
       addressRoot += "/"
-
     for instrumentIndex in range(int(parameterNode.GetParameter("MaxNumberOfInstruments"))):
       instrumentName = parameterNode.GetParameter("InstrumentName"+str(instrumentIndex))
       self.instrumentOscAddress.append(addressRoot+instrumentName+"/")
-      if not instrumentName:
+
+  def updateInstrumentNodeObservers(self):
+    """Add and remove observers so that they match the current instrument configuration.
+    Observers of nodes that are still in use are kept, and each node and event is observed only once.
+    """
+    self.updateInstrumentOscAddresses()
+    requiredObservations = self.getRequiredInstrumentNodeObservations()
+
+    for key in list(self.instrumentNodeObservations):
+      if key in requiredObservations:
         continue
-      instrumentNode = parameterNode.GetNodeReference("InstrumentSource"+str(instrumentIndex))
-      if not instrumentName:
+      node, tag, instrumentIndices = self.instrumentNodeObservations.pop(key)
+      node.RemoveObserver(tag)
+      # Target node may not be observed anymore, therefore cached geometry may become outdated
+      self.targetGeometryCache.pop(key[0], None)
+
+    for key, [node, instrumentIndices] in requiredObservations.items():
+      if key in self.instrumentNodeObservations:
+        # Already observed, just update the list of instruments that depend on it
+        self.instrumentNodeObservations[key][2] = instrumentIndices
         continue
-      if instrumentNode.IsA("vtkMRMLTransformNode"):
-        self.instrumentNodeObserverTags.append(
-          [instrumentNode, instrumentNode.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent,
-          lambda unused1, unused2, instrumentIndex = instrumentIndex: self.instrumentNodeUpdated(instrumentIndex))])
-      elif instrumentNode.IsA("vtkMRMLBreachWarningNode"):
-        self.instrumentNodeObserverTags.append(
-          [instrumentNode, instrumentNode.AddObserver(vtk.vtkCommand.ModifiedEvent,
-          lambda unused1, unused2, instrumentIndex = instrumentIndex: self.instrumentNodeUpdated(instrumentIndex))])
-      referenceNode = parameterNode.GetNodeReference("InstrumentReference"+str(instrumentIndex))
-      if referenceNode:
-        self.instrumentNodeObserverTags.append(
-          [referenceNode, referenceNode.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent,
-          lambda unused1, unused2, instrumentIndex = instrumentIndex: self.instrumentNodeUpdated(instrumentIndex))])
+      tag = node.AddObserver(key[1], lambda caller, unused, key = key: self.onObservedNodeModified(caller, key))
+      self.instrumentNodeObservations[key] = [node, tag, instrumentIndices]
+
+  def removeParameterNodeObserver(self):
+    if not self.parameterNodeObserverTag:
+      return
+    self.getParameterNode().RemoveObserver(self.parameterNodeObserverTag)
+    self.parameterNodeObserverTag = None
 
   def removeAllInstrumentNodeObservers(self):
-    for nodeTagPair in self.instrumentNodeObserverTags:
-      nodeTagPair[0].RemoveObserver(nodeTagPair[1])
+    for node, tag, instrumentIndices in self.instrumentNodeObservations.values():
+      node.RemoveObserver(tag)
+    self.instrumentNodeObservations = {}
+    # Target nodes are not observed anymore, therefore cached geometry may become outdated
+    self.targetGeometryCache = {}
+
+  def getNumberOfInstrumentNodeObservers(self, node=None, event=None):
+    """Get number of observers added to instrument, reference, and target nodes.
+    If node and/or event is specified then only observers of that node and/or event are counted.
+    """
+    numberOfObservers = 0
+    for nodeID, observedEvent in self.instrumentNodeObservations:
+      if node and nodeID != node.GetID():
+        continue
+      if event is not None and observedEvent != event:
+        continue
+      numberOfObservers += 1
+    return numberOfObservers
+
+  def onObservedNodeModified(self, node, key):
+    observation = self.instrumentNodeObservations.get(key)
+    if not observation:
+      return
+    if node.IsA("vtkMRMLMarkupsNode"):
+      self.targetGeometryCache.pop(node.GetID(), None)
+    for instrumentIndex in observation[2]:
+      self.instrumentNodeUpdated(instrumentIndex)
+
+  def onParameterNodeModified(self, unused1=None, unused2=None):
+    parameterNode = self.getParameterNode()
+    hostPort = (parameterNode.GetParameter("ConnectionHostName"), int(parameterNode.GetParameter("ConnectionPort")))
+    if hostPort != self.oscConnectionHostPort:
+      self.oscConnect()
+    self.updateSendQueue()
+    self.updateInstrumentNodeObservers()
+    self.updateParameterMapper()
+    self.updateWorker()
+
+  def updateSendQueue(self):
+    maxMessagesPerTick = self.getParameterNode().GetParameter("MaxMessagesPerTick")
+    maxMessagesPerTick = int(maxMessagesPerTick) if maxMessagesPerTick else 0
+    if maxMessagesPerTick != self.oscLogic.maxMessagesPerTick:
+      self.oscLogic.setSendQueue(maxMessagesPerTick)
+
+  def oscConnect(self):
+    parameterNode = self.getParameterNode()
+    self.oscConnectionHostPort = (parameterNode.GetParameter("ConnectionHostName"), int(parameterNode.GetParameter("ConnectionPort")))
+    self.oscLogic.oscConnect(*self.oscConnectionHostPort)
 
   def createParameterNode(self):
     parameterNode = ScriptedLoadableModuleLogic.createParameterNode(self)
@@ -285,20 +518,204 @@ class SoundNavLogic(ScriptedLoadableModuleLogic):
     parameterNode.SetParameter("ConnectionPort", "7400")
     parameterNode.SetParameter("AddressRoot", "SoundNav")
     parameterNode.SetParameter("InstrumentName0", "Instrument")
+    # Direction of the instrument shaft in the instrument coordinate system (used for computing angle to trajectory)
+    for instrumentIndex in range(int(parameterNode.GetParameter("MaxNumberOfInstruments"))):
+      parameterNode.SetParameter("InstrumentDirection"+str(instrumentIndex), "0 0 1")
+    # Maximum number of messages sent in each 10ms. 0 means all messages are sent immediately.
+    parameterNode.SetParameter("MaxMessagesPerTick", "0")
+    # Compute and send sound parameters in a separate process (priority classes and MaxMessagesPerTick are not used then)
+    parameterNode.SetParameter("WorkerProcessEnabled", "false")
+    # Weight of new values in exponential smoothing performed by the worker process (1.0 = no smoothing)
+    parameterNode.SetParameter("WorkerSmoothingFactor", "1.0")
+    # Transfer functions from navigation values to sound parameters (JSON, see SoundNavLib/ParameterMapping.py)
+    parameterNode.SetParameter("ParameterMappings", "{}")
     return parameterNode
 
   def startTransmission(self):
-    self.removeAllInstrumentNodeObservers()
     parameterNode = self.getParameterNode()
-    self.oscLogic.oscConnect(parameterNode.GetParameter("ConnectionHostName"), int(parameterNode.GetParameter("ConnectionPort")))
-    self.addInstrumentNodeObservers()
+    self.oscConnect()
+    self.updateSendQueue()
+    self.updateInstrumentNodeObservers()
+    # Recompile mappings to send all mapped values when transmission starts
+    self.parameterMappings = None
+    self.updateParameterMapper()
+    self.updateWorker()
+    # Apply configuration changes while transmission is active, without interrupting the connection
+    if not self.parameterNodeObserverTag:
+      self.parameterNodeObserverTag = parameterNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onParameterNodeModified)
 
   def stopTransmission(self):
+    self.removeParameterNodeObserver()
     self.removeAllInstrumentNodeObservers()
+    self.stopWorker()
+    # Pending values are outdated when transmission is stopped, they must not be sent anymore
+    self.oscLogic.discardQueuedMessages()
+    self.oscLogic.setSendQueue(0)
+
+  def updateParameterMapper(self):
+    """Compile transfer functions if they have been changed in the parameter node.
+    """
+    parameterMappings = self.getParameterNode().GetParameter("ParameterMappings")
+    if parameterMappings == self.parameterMappings:
+      return
+    import json
+    # Invalid mappings are reported once, they are not compiled again until they are changed
+    self.parameterMappings = parameterMappings
+    for outputName in self.parameterMappingOutputNames:
+      self.oscLogic.removeAddressPriorityClass("/"+outputName)
+    self.parameterMappingOutputNames = []
+    try:
+      mappingDefinitions = json.loads(parameterMappings) if parameterMappings else {}
+      # Mapped values are sent to the same address root as the instrument parameters, names must not collide
+      reservedNames = SonificationWorker.TRANSFORM_PARAMETER_NAMES + SonificationWorker.PLAN_METRIC_NAMES
+      for outputName in mappingDefinitions:
+        if outputName in reservedNames:
+          raise ValueError("Mapping output name '"+outputName+"' is already used by an instrument parameter")
+      self.parameterMapper = ParameterMapping.ParameterMapper(mappingDefinitions) if mappingDefinitions else None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+      logging.error("Invalid parameter mappings, mapped values are not sent: {0}".format(e))
+      self.parameterMapper = None
+      return
+    # Mapped values are only sent when they change, therefore they must not be dropped by the send queue
+    self.parameterMappingOutputNames = list(mappingDefinitions)
+    for outputName in self.parameterMappingOutputNames:
+      self.oscLogic.setAddressPriorityClass("/"+outputName, "high")
+
+  def updateWorker(self):
+    """Start, restart, or stop the worker process to match the current configuration.
+    """
+    parameterNode = self.getParameterNode()
+    if not slicer.util.toBool(parameterNode.GetParameter("WorkerProcessEnabled")):
+      self.stopWorker()
+      self.workerNumberOfFailedStarts = 0
+      return
+    if self.workerProcess and self.workerProcess.poll() is None:
+      if (self.workerInstrumentOscAddress == self.instrumentOscAddress
+        and self.workerConnectionHostPort == self.oscConnectionHostPort
+        and self.workerSmoothingFactor == self.getWorkerSmoothingFactor()
+        and self.workerParameterMappings == self.parameterMappings):
+        # Worker is running with the current configuration
+        return
+    try:
+      self.startWorker()
+    except (RuntimeError, OSError) as e:
+      self.disableWorker("Sonification worker process cannot be started: {0}".format(e))
+
+  def disableWorker(self, message):
+    """Stop the worker and disable it in the parameter node, values are then sent from the application process.
+    """
+    logging.error(message+". Worker process is disabled.")
+    self.stopWorker()
+    self.getParameterNode().SetParameter("WorkerProcessEnabled", "false")
+
+  def getWorkerSmoothingFactor(self):
+    smoothingFactor = self.getParameterNode().GetParameter("WorkerSmoothingFactor")
+    return float(smoothingFactor) if smoothingFactor else 1.0
+
+  def startWorker(self):
+    import json, shutil, subprocess
+    self.stopWorker()
+    pythonSlicerExecutablePath = shutil.which("PythonSlicer")
+    if not pythonSlicerExecutablePath:
+      raise RuntimeError("PythonSlicer executable not found, worker process cannot be started.")
+    ringBuffer = SonificationWorker.SonificationRingBuffer(
+      numberOfInstruments=int(self.getParameterNode().GetParameter("MaxNumberOfInstruments")))
+    self.workerInstrumentOscAddress = list(self.instrumentOscAddress)
+    self.workerConnectionHostPort = self.oscConnectionHostPort
+    self.workerSmoothingFactor = self.getWorkerSmoothingFactor()
+    self.workerParameterMappings = self.parameterMappings
+    # Invalid mappings are not passed to the worker
+    workerMappingDefinitions = self.workerParameterMappings if self.parameterMapper else "{}"
+    args = [pythonSlicerExecutablePath, SonificationWorker.__file__,
+      "--shared-memory-name", ringBuffer.name,
+      "--host", self.workerConnectionHostPort[0],
+      "--port", str(self.workerConnectionHostPort[1]),
+      "--addresses", json.dumps(self.workerInstrumentOscAddress),
+      "--smoothing-factor", str(self.workerSmoothingFactor),
+      "--mappings", workerMappingDefinitions,
+      "--parent-pid", str(os.getpid())]
+    if not SonificationWorker.STRONG_MEMORY_ORDERING:
+      logging.warning("Sonification worker ring buffer relies on x86 memory ordering. On this CPU ({0}) sound parameters"
+        " may be occasionally computed from incompletely written records.".format(platform.machine()))
+    logging.info("Start sonification worker process")
+    try:
+      self.workerProcess = subprocess.Popen(args)
+    except Exception:
+      ringBuffer.close()
+      raise
+    # Instrument updates are only written to the buffer if there is a worker that reads it
+    self.workerRingBuffer = ringBuffer
+    self.workerStartTime = time.perf_counter()
+    self.workerMonitorTimer.start()
+
+  def stopWorker(self):
+    self.workerMonitorTimer.stop()
+    if self.workerRingBuffer:
+      self.workerRingBuffer.header[SonificationWorker.HEADER_STOP_REQUESTED] = 1
+    if self.workerProcess:
+      logging.info("Stop sonification worker process")
+      try:
+        self.workerProcess.wait(timeout=2)
+      except Exception:
+        self.workerProcess.kill()
+      self.workerProcess = None
+    if self.workerRingBuffer:
+      self.workerRingBuffer.close()
+      self.workerRingBuffer = None
+
+  def isWorkerResponsive(self):
+    """Check that the worker process is running and it is not stuck (it updates its heartbeat).
+    """
+    if not self.workerProcess or self.workerProcess.poll() is not None or not self.workerRingBuffer:
+      return False
+    heartbeatAgeSec = self.workerRingBuffer.getMetrics()["workerHeartbeatAgeSec"]
+    if heartbeatAgeSec is None:
+      # Worker has not started processing yet
+      return time.perf_counter() - self.workerStartTime < self.workerStartupTimeoutSec
+    return heartbeatAgeSec < self.workerHeartbeatTimeoutSec
+
+  def onWorkerMonitorTimeout(self):
+    if not self.workerRingBuffer:
+      return
+    if not self.isWorkerResponsive():
+      if self.workerProcess.poll() is None:
+        logging.error("Sonification worker process is not responding, it is restarted")
+        self.workerProcess.kill()
+        self.workerProcess.wait()
+      else:
+        logging.error("Sonification worker process exited unexpectedly (exit code: {0})".format(self.workerProcess.returncode))
+      if time.perf_counter() - self.workerStartTime < self.workerMinimumRunTimeSec:
+        self.workerNumberOfFailedStarts += 1
+      else:
+        self.workerNumberOfFailedStarts = 0
+      if self.workerNumberOfFailedStarts >= self.workerMaximumNumberOfFailedStarts:
+        self.disableWorker("Sonification worker process fails repeatedly after it is started")
+        return
+      self.updateWorker()
+      return
+    metrics = self.workerRingBuffer.getMetrics()
+    if metrics["backlog"] > self.workerRingBuffer.capacity / 2:
+      logging.warning("Sonification worker cannot keep up with incoming data (backlog: {0} records)".format(metrics["backlog"]))
+
+  def getLatencyMetrics(self):
+    """Get latency of the in-process path and health, backlog, and latency of the worker process.
+    Latency is measured for each message, from the instrument update event until the message is sent.
+    """
+    metrics = {
+      "inProcess": self.oscLogic.getSendLatencyMetrics(),
+      "worker": None,
+      }
+    if self.workerRingBuffer:
+      metrics["worker"] = self.workerRingBuffer.getMetrics()
+      metrics["worker"]["running"] = self.isWorkerResponsive()
+    return metrics
 
   def instrumentNodeUpdated(self, instrumentIndex):
+    updateStartTime = time.perf_counter()
     parameterNode = self.getParameterNode()
     instrumentNode = parameterNode.GetNodeReference("InstrumentSource"+str(instrumentIndex))
+    if not instrumentNode:
+      return
     address = self.instrumentOscAddress[instrumentIndex]
 
     if instrumentNode.IsA("vtkMRMLTransformNode"):
@@ -309,25 +726,178 @@ class SoundNavLogic(ScriptedLoadableModuleLogic):
         parameterNode.GetNodeReference("InstrumentReference"+str(instrumentIndex)),
         instrumentToReferenceMatrix)
 
+      if self.workerRingBuffer:
+        # Feature computation and sending is performed in the worker process
+        self.workerRingBuffer.write(SonificationWorker.makeRecord(updateStartTime, instrumentIndex,
+          SonificationWorker.RECORD_TYPE_TRANSFORM, matrix=slicer.util.arrayFromVTKMatrix(instrumentToReferenceMatrix),
+          planMetrics=self.getPlanMetrics(instrumentIndex)))
+        return
+
       instrumentToReference = vtk.vtkTransform()
       instrumentToReference.SetMatrix(instrumentToReferenceMatrix)
 
       translation = instrumentToReference.GetPosition()
       orientation = instrumentToReference.GetOrientation()
       orientationWXYZ = instrumentToReference.GetOrientationWXYZ()
-      self.oscLogic.oscSendMessage(address+"TranslationX", translation[0])
-      self.oscLogic.oscSendMessage(address+"TranslationY", translation[1])
-      self.oscLogic.oscSendMessage(address+"TranslationZ", translation[2])
-      self.oscLogic.oscSendMessage(address+"Distance", vtk.vtkMath.Norm(translation))
-      self.oscLogic.oscSendMessage(address+"OrientationX", orientation[0])
-      self.oscLogic.oscSendMessage(address+"OrientationY", orientation[1])
-      self.oscLogic.oscSendMessage(address+"OrientationZ", orientation[2])
-      self.oscLogic.oscSendMessage(address+"Orientation", orientationWXYZ[0])
+      values = {
+        "TranslationX": translation[0],
+        "TranslationY": translation[1],
+        "TranslationZ": translation[2],
+        "Distance": vtk.vtkMath.Norm(translation),
+        "OrientationX": orientation[0],
+        "OrientationY": orientation[1],
+        "OrientationZ": orientation[2],
+        "Orientation": orientationWXYZ[0],
+        }
+      values.update(self.getPlanMetrics(instrumentIndex))
 
     elif instrumentNode.IsA("vtkMRMLBreachWarningNode"):
 
       signedDistance = instrumentNode.GetClosestDistanceToModelFromToolTip()
-      self.oscLogic.oscSendMessage(address+"Distance", signedDistance)
+      if self.workerRingBuffer:
+        self.workerRingBuffer.write(SonificationWorker.makeRecord(updateStartTime, instrumentIndex,
+          SonificationWorker.RECORD_TYPE_DISTANCE, distance=signedDistance))
+        return
+      values = {"Distance": signedDistance}
+
+    else:
+      return
+
+    # Update start time is passed so that latency is measured until the message is actually sent
+    for parameterName, value in values.items():
+      self.oscLogic.oscQueueMessage(address+parameterName, value, updateStartTime)
+    if self.parameterMapper:
+      # Mapped values are only sent if they have changed
+      for outputName, outputValue in self.parameterMapper.mapValues(instrumentIndex, values).items():
+        self.oscLogic.oscQueueMessage(address+outputName, outputValue, updateStartTime)
+
+  def getTrajectoryGeometry(self, trajectoryNode):
+    """Get polyline segments of a line or curve markups node as numpy arrays.
+    Returns None if the trajectory has less than 2 points.
+    """
+    geometry = self.targetGeometryCache.get(trajectoryNode.GetID())
+    if geometry is not None:
+      return geometry
+    points = slicer.util.arrayFromMarkupsCurvePoints(trajectoryNode, world=True)
+    if points is None or len(points) < 2:
+      return None
+    # Remove repeated points, as zero-length segments do not define a direction
+    distinctPoints = np.concatenate([[True], np.linalg.norm(np.diff(points, axis=0), axis=1) > 0])
+    points = points[distinctPoints]
+    if len(points) < 2:
+      return None
+    segmentStarts = points[:-1]
+    segmentVectors = points[1:] - points[:-1]
+    segmentLengths = np.linalg.norm(segmentVectors, axis=1)
+    geometry = {
+      'segmentStarts': segmentStarts,
+      'segmentVectors': segmentVectors,
+      'segmentLengthsSquared': segmentLengths ** 2,
+      'segmentDirections': segmentVectors / segmentLengths[:, np.newaxis],
+      'segmentStartDepths': np.concatenate([[0.0], np.cumsum(segmentLengths)[:-1]]),
+      'segmentLengths': segmentLengths,
+      }
+    self.targetGeometryCache[trajectoryNode.GetID()] = geometry
+    return geometry
+
+  def getLandmarksGeometry(self, landmarksNode):
+    """Get landmark point positions as numpy array. Returns None if there are no points.
+    """
+    geometry = self.targetGeometryCache.get(landmarksNode.GetID())
+    if geometry is not None:
+      return geometry
+    points = slicer.util.arrayFromMarkupsControlPoints(landmarksNode, world=True)
+    if points is None or len(points) == 0:
+      return None
+    geometry = {'points': points}
+    self.targetGeometryCache[landmarksNode.GetID()] = geometry
+    return geometry
+
+  @staticmethod
+  def computeTrajectoryMetrics(trajectoryGeometry, instrumentPosition, instrumentDirection):
+    """Compute distance, depth, and angle of the instrument relative to a polyline trajectory.
+    Before the first and after the last point the trajectory is extended along the first/last segment,
+    so for a straight line the distance is the point-to-line distance and depth can be negative
+    (before entry point) or larger than the trajectory length (beyond target point).
+    Returns (distance, depth, angle in degrees).
+    """
+    segmentStarts = trajectoryGeometry['segmentStarts']
+    segmentVectors = trajectoryGeometry['segmentVectors']
+    # Parametric position of the closest point on each segment (0 = segment start, 1 = segment end)
+    t = np.einsum('ij,ij->i', instrumentPosition - segmentStarts, segmentVectors) / trajectoryGeometry['segmentLengthsSquared']
+    lowerBound = np.zeros(len(t))
+    upperBound = np.ones(len(t))
+    lowerBound[0] = -np.inf
+    upperBound[-1] = np.inf
+    t = np.clip(t, lowerBound, upperBound)
+    closestPoints = segmentStarts + t[:, np.newaxis] * segmentVectors
+    distances = np.linalg.norm(instrumentPosition - closestPoints, axis=1)
+    closestSegmentIndex = np.argmin(distances)
+    depth = trajectoryGeometry['segmentStartDepths'][closestSegmentIndex] + t[closestSegmentIndex] * trajectoryGeometry['segmentLengths'][closestSegmentIndex]
+    cosAngle = np.dot(instrumentDirection, trajectoryGeometry['segmentDirections'][closestSegmentIndex])
+    angleDeg = np.degrees(np.arccos(np.clip(cosAngle, -1.0, 1.0)))
+    return distances[closestSegmentIndex], depth, angleDeg
+
+  @staticmethod
+  def computeLandmarksMetrics(landmarksGeometry, instrumentPosition):
+    """Returns (distance, index) of the landmark point nearest to the instrument position.
+    """
+    distances = np.linalg.norm(landmarksGeometry['points'] - instrumentPosition, axis=1)
+    nearestIndex = np.argmin(distances)
+    return distances[nearestIndex], nearestIndex
+
+  def getPlanMetrics(self, instrumentIndex):
+    """Get distance and angle metrics of the instrument relative to planned trajectory and landmarks.
+    Returns dict of parameter name -> value.
+    """
+    planMetrics = {}
+    parameterNode = self.getParameterNode()
+    trajectoryNode = parameterNode.GetNodeReference("InstrumentTrajectory"+str(instrumentIndex))
+    landmarksNode = parameterNode.GetNodeReference("InstrumentLandmarks"+str(instrumentIndex))
+    if not trajectoryNode and not landmarksNode:
+      return planMetrics
+
+    instrumentNode = parameterNode.GetNodeReference("InstrumentSource"+str(instrumentIndex))
+    instrumentToWorldMatrix = vtk.vtkMatrix4x4()
+    instrumentNode.GetMatrixTransformToWorld(instrumentToWorldMatrix)
+    instrumentToWorld = slicer.util.arrayFromVTKMatrix(instrumentToWorldMatrix)
+    instrumentPosition = instrumentToWorld[0:3, 3]
+
+    trajectoryGeometry = self.getTrajectoryGeometry(trajectoryNode) if trajectoryNode else None
+    if trajectoryGeometry is not None:
+      instrumentDirection = np.dot(instrumentToWorld[0:3, 0:3], self.getInstrumentDirection(instrumentIndex))
+      instrumentDirection /= np.linalg.norm(instrumentDirection)
+      distance, depth, angleDeg = self.computeTrajectoryMetrics(trajectoryGeometry, instrumentPosition, instrumentDirection)
+      planMetrics["TrajectoryDistance"] = float(distance)
+      planMetrics["TrajectoryDepth"] = float(depth)
+      planMetrics["TrajectoryAngle"] = float(angleDeg)
+
+    landmarksGeometry = self.getLandmarksGeometry(landmarksNode) if landmarksNode else None
+    if landmarksGeometry is not None:
+      distance, nearestIndex = self.computeLandmarksMetrics(landmarksGeometry, instrumentPosition)
+      planMetrics["LandmarkDistance"] = float(distance)
+      planMetrics["LandmarkIndex"] = int(nearestIndex)
+
+    return planMetrics
+
+  def getInstrumentDirection(self, instrumentIndex):
+    directionStr = self.getParameterNode().GetParameter("InstrumentDirection"+str(instrumentIndex))
+    cachedDirection = self.instrumentDirections.get(instrumentIndex)
+    if cachedDirection and cachedDirection[0] == directionStr:
+      return cachedDirection[1]
+    # Parameter value is validated only when it changes, so that errors are reported only once
+    defaultDirection = np.array([0.0, 0.0, 1.0])
+    direction = defaultDirection
+    if directionStr:
+      try:
+        direction = np.array([float(component) for component in directionStr.split()])
+        if len(direction) != 3 or not np.all(np.isfinite(direction)) or np.linalg.norm(direction) == 0:
+          raise ValueError("three finite numbers are required, not all zero")
+      except ValueError as e:
+        logging.error("Invalid InstrumentDirection{0} value '{1}' ({2}), using default direction (0 0 1)".format(instrumentIndex, directionStr, e))
+        direction = defaultDirection
+    self.instrumentDirections[instrumentIndex] = [directionStr, direction]
+    return direction
 
   def hasImageData(self,volumeNode):
     """This is an example logic method that
@@ -360,6 +930,14 @@ class SoundNavTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_SoundNav1()
+    self.setUp()
+    self.test_SoundNavPlanMetrics()
+    self.setUp()
+    self.test_SoundNavObservers()
+    self.setUp()
+    self.test_SoundNavWorker()
+    self.setUp()
+    self.test_SoundNavParameterMapping()
 
   def test_SoundNav1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -396,3 +974,217 @@ class SoundNavTest(ScriptedLoadableModuleTest):
     logic = SoundNavLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_SoundNavPlanMetrics(self):
+    """Check distance metrics of an instrument relative to planned trajectory and landmarks.
+    """
+    self.delayDisplay("Starting the plan metrics test")
+    logic = SoundNavLogic()
+
+    trajectoryNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode")
+    trajectoryNode.AddControlPoint(vtk.vtkVector3d(0, 0, 0))
+    trajectoryNode.AddControlPoint(vtk.vtkVector3d(0, 0, 0))
+    # Trajectory with coincident points does not define a direction
+    self.assertIsNone(logic.getTrajectoryGeometry(trajectoryNode))
+    trajectoryNode.SetNthControlPointPosition(1, 0, 0, 100)
+    trajectoryGeometry = logic.getTrajectoryGeometry(trajectoryNode)
+
+    distance, depth, angleDeg = logic.computeTrajectoryMetrics(trajectoryGeometry, np.array([3, 4, 30]), np.array([0, 0, 1]))
+    self.assertAlmostEqual(distance, 5.0)
+    self.assertAlmostEqual(depth, 30.0)
+    self.assertAlmostEqual(angleDeg, 0.0)
+
+    # Beyond the target point the trajectory is extended
+    distance, depth, angleDeg = logic.computeTrajectoryMetrics(trajectoryGeometry, np.array([0, 0, 110]), np.array([0, 1, 0]))
+    self.assertAlmostEqual(distance, 0.0)
+    self.assertAlmostEqual(depth, 110.0)
+    self.assertAlmostEqual(angleDeg, 90.0)
+
+    landmarksNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+    for landmarkIndex in range(200):
+      landmarksNode.AddControlPoint(vtk.vtkVector3d(landmarkIndex * 10, 0, 0))
+    distance, nearestIndex = logic.computeLandmarksMetrics(logic.getLandmarksGeometry(landmarksNode), np.array([52, 0, 0]))
+    self.assertAlmostEqual(distance, 2.0)
+    self.assertEqual(nearestIndex, 5)
+
+    # Invalid instrument direction is replaced by the default direction
+    parameterNode = logic.getParameterNode()
+    for directionStr in ["1 0", "1 x 0", "0 0 0", "nan 0 1"]:
+      parameterNode.SetParameter("InstrumentDirection0", directionStr)
+      self.assertEqual(list(logic.getInstrumentDirection(0)), [0.0, 0.0, 1.0])
+    parameterNode.SetParameter("InstrumentDirection0", "1 0 0")
+    self.assertEqual(list(logic.getInstrumentDirection(0)), [1.0, 0.0, 0.0])
+
+    self.delayDisplay('Test passed!')
+
+  def test_SoundNavObservers(self):
+    """Check that configuration changes add and remove only the affected observers.
+    """
+    self.delayDisplay("Starting the observers test")
+    logic = SoundNavLogic()
+    parameterNode = logic.getParameterNode()
+    transformModifiedEvent = slicer.vtkMRMLTransformableNode.TransformModifiedEvent
+
+    instrumentNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    referenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    parameterNode.SetParameter("InstrumentName0", "Needle")
+    parameterNode.SetNodeReferenceID("InstrumentSource0", instrumentNode.GetID())
+    parameterNode.SetNodeReferenceID("InstrumentReference0", referenceNode.GetID())
+
+    # Repeated start/stop must not accumulate observers
+    for i in range(3):
+      logic.startTransmission()
+      self.assertEqual(logic.getNumberOfInstrumentNodeObservers(), 2)
+      logic.stopTransmission()
+      self.assertEqual(logic.getNumberOfInstrumentNodeObservers(), 0)
+
+    logic.startTransmission()
+
+    # Send budget is applied while transmitting
+    parameterNode.SetParameter("MaxMessagesPerTick", "5")
+    self.assertEqual(logic.oscLogic.maxMessagesPerTick, 5)
+    parameterNode.SetParameter("MaxMessagesPerTick", "0")
+
+    # Second instrument that uses the same reference: the reference node is still observed only once
+    parameterNode.SetParameter("InstrumentName1", "Pointer")
+    parameterNode.SetNodeReferenceID("InstrumentSource1", slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode").GetID())
+    parameterNode.SetNodeReferenceID("InstrumentReference1", referenceNode.GetID())
+    self.assertEqual(logic.getNumberOfInstrumentNodeObservers(), 3)
+    self.assertEqual(logic.getNumberOfInstrumentNodeObservers(referenceNode, transformModifiedEvent), 1)
+
+    # Removing the reference of the first instrument keeps the observer for the second instrument
+    parameterNode.SetNodeReferenceID("InstrumentReference0", None)
+    self.assertEqual(logic.getNumberOfInstrumentNodeObservers(referenceNode), 1)
+    parameterNode.SetParameter("InstrumentName1", "")
+    self.assertEqual(logic.getNumberOfInstrumentNodeObservers(referenceNode), 0)
+    self.assertEqual(logic.getNumberOfInstrumentNodeObservers(instrumentNode), 1)
+
+    logic.stopTransmission()
+    self.assertEqual(logic.getNumberOfInstrumentNodeObservers(), 0)
+    self.delayDisplay('Test passed!')
+
+  def test_SoundNavWorker(self):
+    """Check that the worker computes the same parameters as the in-process path and that the ring buffer reports backlog.
+    """
+    self.delayDisplay("Starting the worker test")
+
+    transform = vtk.vtkTransform()
+    transform.Translate(10, -20, 30)
+    transform.RotateZ(25)
+    transform.RotateX(-40)
+    transform.RotateY(70)
+    matrix = slicer.util.arrayFromVTKMatrix(transform.GetMatrix())
+    features = SonificationWorker.computeTransformFeatures(matrix[np.newaxis, :, :])
+    for featureIndex, featureName in enumerate(["OrientationX", "OrientationY", "OrientationZ"]):
+      self.assertAlmostEqual(features[featureName][0], transform.GetOrientation()[featureIndex], places=5)
+    self.assertAlmostEqual(features["Orientation"][0], transform.GetOrientationWXYZ()[0], places=5)
+    self.assertAlmostEqual(features["Distance"][0], vtk.vtkMath.Norm(transform.GetPosition()), places=5)
+
+    ringBuffer = SonificationWorker.SonificationRingBuffer(capacity=4)
+    try:
+      for recordIndex in range(6):
+        ringBuffer.write(SonificationWorker.makeRecord(time.perf_counter(), 0, SonificationWorker.RECORD_TYPE_DISTANCE, distance=recordIndex))
+      metrics = ringBuffer.getMetrics()
+      self.assertEqual(metrics["backlog"], 4)
+      # Records that do not fit into the full buffer are kept in the latest value slot of the instrument
+      self.assertEqual(metrics["droppedCount"], 0)
+
+      class MessageRecorder:
+        def __init__(self):
+          self.messages = []
+        def send_message(self, address, value):
+          self.messages.append((address, value))
+      messageRecorder = MessageRecorder()
+      worker = SonificationWorker.SonificationWorker(ringBuffer, messageRecorder, ["/SoundNav/Instrument/"])
+      worker.processRecords(ringBuffer.readAll())
+      metrics = ringBuffer.getMetrics()
+      self.assertEqual(metrics["backlog"], 0)
+      # Only the value that was replaced in the latest value slot is lost
+      self.assertEqual(metrics["droppedCount"], 1)
+      # All records are processed but records of the same instrument are coalesced and only the newest value is sent
+      self.assertEqual(metrics["processedCount"], 5)
+      self.assertEqual(metrics["sentCount"], 1)
+      self.assertEqual(messageRecorder.messages, [("/SoundNav/Instrument/Distance", 5.0)])
+    finally:
+      ringBuffer.close()
+
+    self.delayDisplay('Test passed!')
+
+  def test_SoundNavParameterMapping(self):
+    """Check transfer functions and that only changed mapped values are returned.
+    """
+    self.delayDisplay("Starting the parameter mapping test")
+    mapper = ParameterMapping.ParameterMapper({
+      "Tempo": {"input": "Distance", "type": "linear", "inputRange": [0, 100], "outputRange": [240, 60]},
+      "Frequency": {"input": "Distance", "type": "scale", "inputRange": [0, 100], "noteRange": [69, 81], "scale": [9, 1, 4]},
+      "Alarm": {"input": "Distance", "type": "zones", "thresholds": [10], "values": [1, 0], "hysteresis": 2.0},
+      })
+
+    outputs = mapper.mapValues(0, {"Distance": 0.0})
+    self.assertAlmostEqual(outputs["Tempo"], 240.0)
+    self.assertAlmostEqual(outputs["Frequency"], 440.0)
+    self.assertEqual(outputs["Alarm"], 1)
+
+    # Unchanged values are not returned
+    self.assertEqual(mapper.mapValues(0, {"Distance": 0.0}), {})
+
+    # Input is clamped to the input range
+    self.assertAlmostEqual(mapper.mapValues(0, {"Distance": 500.0})["Tempo"], 60.0)
+
+    # Zone is only changed when the input gets beyond the threshold by more than the hysteresis
+    mapper.mapValues(0, {"Distance": 5.0})
+    self.assertNotIn("Alarm", mapper.mapValues(0, {"Distance": 11.0}))
+    self.assertEqual(mapper.mapValues(0, {"Distance": 12.5})["Alarm"], 0)
+
+    # Invalid mappings are ignored
+    logic = SoundNavLogic()
+    parameterNode = logic.getParameterNode()
+    for invalidMappings in ['{"Alarm": ', '{"Alarm": {"input": "Distance", "type": "zones", "thresholds": [10], "values": [1]}}', '[1]',
+      '{"OrientationX": {"input": "Distance", "type": "linear", "inputRange": [0, 100], "outputRange": [0, 1]}}']:
+      parameterNode.SetParameter("ParameterMappings", invalidMappings)
+      logic.updateParameterMapper()
+      self.assertIsNone(logic.parameterMapper)
+    self.assertEqual(logic.oscLogic.getAddressPriorityClass("/SoundNav/Needle/OrientationX"), "low")
+
+    # Priority of outputs of previous mappings is removed
+    parameterNode.SetParameter("ParameterMappings", '{"Tempo": {"input": "Distance", "type": "linear", "inputRange": [0, 100], "outputRange": [240, 60]}}')
+    logic.updateParameterMapper()
+    self.assertEqual(logic.oscLogic.getAddressPriorityClass("/SoundNav/Needle/Tempo"), "high")
+    parameterNode.SetParameter("ParameterMappings", "{}")
+    logic.updateParameterMapper()
+    self.assertEqual(logic.oscLogic.getAddressPriorityClass("/SoundNav/Needle/Tempo"), logic.oscLogic.defaultPriorityClass)
+
+    # Mapped values are sent even if the send queue drops other messages
+    instrumentNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    referenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    parameterNode.SetParameter("InstrumentName0", "Needle")
+    parameterNode.SetNodeReferenceID("InstrumentSource0", instrumentNode.GetID())
+    parameterNode.SetNodeReferenceID("InstrumentReference0", referenceNode.GetID())
+    parameterNode.SetParameter("MaxMessagesPerTick", "1")
+    parameterNode.SetParameter("ParameterMappings", '{"Alarm": {"input": "Distance", "type": "zones", "thresholds": [10], "values": [1, 0]}}')
+
+    class MessageRecorder:
+      def __init__(self):
+        self.messages = []
+      def send_message(self, address, value):
+        self.messages.append((address, value))
+    messageRecorder = MessageRecorder()
+    logic.startTransmission()
+    try:
+      logic.oscLogic.sendQueueTimer.stop()
+      logic.oscLogic.oscClient = messageRecorder
+      logic.oscLogic.resetMessageCounters()
+      instrumentToReference = vtk.vtkMatrix4x4()
+      instrumentToReference.SetElement(2, 3, 5.0)
+      instrumentNode.SetMatrixTransformToParent(instrumentToReference)
+      instrumentToReference.SetElement(2, 3, 20.0)
+      instrumentNode.SetMatrixTransformToParent(instrumentToReference)
+      # Deadline of all queued messages is exceeded
+      logic.oscLogic.oscSendQueuedMessages(time.perf_counter() + 1.0)
+      self.assertGreater(logic.oscLogic.getMessageCounters()["low"]["dropped"], 0)
+      self.assertIn(("/SoundNav/Needle/Alarm", 1), messageRecorder.messages)
+      self.assertIn(("/SoundNav/Needle/Alarm", 0), messageRecorder.messages)
+    finally:
+      logic.stopTransmission()
+
+    self.delayDisplay('Test passed!')
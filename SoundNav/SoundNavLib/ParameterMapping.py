@@ -0,0 +1,186 @@
+"""Mapping of navigation values (distances, angles, etc.) to sound parameters (frequency, tempo, etc.).
+
+Mappings are defined by a dict (stored as JSON string in the SoundNav parameter node), where the key is the output
+parameter name and the value describes the transfer function. For example:
+
+  {
+    "Frequency": {"input": "TrajectoryDistance", "type": "scale", "inputRange": [0, 50], "noteRange": [84, 48], "scale": [0, 2, 4, 7, 9]},
+    "Tempo": {"input": "Distance", "type": "log", "inputRange": [1, 100], "outputRange": [240, 60]},
+    "Volume": {"input": "TrajectoryAngle", "type": "piecewise", "points": [[0, 1.0], [5, 1.0], [30, 0.2]]},
+    "Alarm": {"input": "Distance", "type": "zones", "thresholds": [5, 10], "values": [2, 1, 0], "hysteresis": 1.0}
+  }
+
+Transfer function types:
+
+- linear: linear mapping of inputRange to outputRange
+- log: logarithmic mapping of inputRange (must be positive) to outputRange
+- piecewise: piecewise-linear function defined by [input, output] points
+- scale: linear mapping of inputRange to MIDI note numbers (noteRange), quantized to the notes of a musical scale
+  (semitone offsets within an octave, default is chromatic), output is frequency in Hz
+- zones: output value changes only when input gets beyond a zone threshold by more than the hysteresis value
+
+Input values are clamped to the input range. All functions except zones are sampled into lookup tables
+when the mapping is compiled, and lookup of all the outputs is performed in a single vectorized operation.
+"""
+
+import math
+import numpy as np
+
+# Semitone offsets of notes in each octave
+CHROMATIC_SCALE = list(range(12))
+
+
+def noteToFrequency(note):
+  """Convert MIDI note number to frequency (A4 = MIDI note 69 = 440Hz).
+  """
+  return 440.0 * 2.0 ** ((np.asarray(note) - 69.0) / 12.0)
+
+
+class ParameterMapper:
+  """Computes sound parameters from navigation values using compiled transfer functions.
+  Only outputs that have changed since the previous call are returned.
+  """
+
+  def __init__(self, mappingDefinitions, lookupTableSize=1024):
+    self.lookupTableSize = lookupTableSize
+
+    # Lookup table based mappings
+    self.lookupOutputNames = []
+    self.lookupInputNames = []
+    inputMins = []
+    inputScales = []
+    inputIsLog = []
+    lookupTables = []
+    # Stateful mappings (zones)
+    self.zoneMappings = {}
+
+    for outputName, definition in mappingDefinitions.items():
+      mappingType = definition.get("type", "linear")
+      if "input" not in definition:
+        raise ValueError("Input parameter is not specified for mapping of "+outputName)
+      if mappingType == "zones":
+        thresholds = np.array(definition["thresholds"], dtype=float)
+        values = list(definition["values"])
+        if len(values) != len(thresholds) + 1:
+          raise ValueError("Number of values must be number of thresholds + 1 in mapping of "+outputName)
+        if np.any(np.diff(thresholds) <= 0):
+          raise ValueError("Thresholds must be in ascending order in mapping of "+outputName)
+        self.zoneMappings[outputName] = {
+          "input": definition["input"],
+          "thresholds": thresholds,
+          "values": values,
+          "hysteresis": float(definition.get("hysteresis", 0.0)),
+          }
+        continue
+      inputMin, inputMax, isLog, lookupTable = self.compileLookupTable(outputName, mappingType, definition)
+      self.lookupOutputNames.append(outputName)
+      self.lookupInputNames.append(definition["input"])
+      inputMins.append(inputMin)
+      inputScales.append((lookupTableSize - 1) / (inputMax - inputMin))
+      inputIsLog.append(isLog)
+      lookupTables.append(lookupTable)
+
+    self.inputMins = np.array(inputMins)
+    self.inputScales = np.array(inputScales)
+    self.inputIsLog = np.array(inputIsLog, dtype=bool)
+    self.lookupTableOffsets = np.arange(len(lookupTables)) * lookupTableSize
+    self.lookupTable = np.concatenate(lookupTables) if lookupTables else np.zeros(0)
+
+    # Key is (instrument index, output name)
+    self.lastOutputValues = {}
+    self.currentZones = {}
+
+  def compileLookupTable(self, outputName, mappingType, definition):
+    """Sample the transfer function into a lookup table.
+    Returns input range minimum, maximum, whether input is log-scaled, and the lookup table.
+    """
+    if mappingType == "piecewise":
+      points = np.array(sorted(definition["points"]), dtype=float)
+      if len(points) < 2:
+        raise ValueError("At least two points are required in mapping of "+outputName)
+      inputMin, inputMax = points[0, 0], points[-1, 0]
+    else:
+      inputMin, inputMax = [float(value) for value in definition["inputRange"]]
+    if inputMin == inputMax:
+      raise ValueError("Input range is empty in mapping of "+outputName)
+
+    isLog = mappingType == "log"
+    if isLog:
+      if inputMin <= 0 or inputMax <= 0:
+        raise ValueError("Input range must be positive for log mapping of "+outputName)
+      inputMin, inputMax = math.log(inputMin), math.log(inputMax)
+
+    # Normalized position of each sample in the input range
+    t = np.linspace(0.0, 1.0, self.lookupTableSize)
+
+    if mappingType in ["linear", "log"]:
+      outputMin, outputMax = [float(value) for value in definition["outputRange"]]
+      lookupTable = outputMin + t * (outputMax - outputMin)
+    elif mappingType == "piecewise":
+      lookupTable = np.interp(inputMin + t * (inputMax - inputMin), points[:, 0], points[:, 1])
+    elif mappingType == "scale":
+      noteFirst, noteLast = [float(value) for value in definition.get("noteRange", [48, 84])]
+      scale = definition.get("scale", CHROMATIC_SCALE)
+      notes = noteFirst + t * (noteLast - noteFirst)
+      allowedNotes = np.array([note for note in range(int(math.floor(min(noteFirst, noteLast))), int(math.ceil(max(noteFirst, noteLast))) + 1)
+        if note % 12 in scale], dtype=float)
+      if len(allowedNotes) == 0:
+        raise ValueError("No notes of the scale are in the note range in mapping of "+outputName)
+      # Quantize to the nearest allowed note
+      nearestNoteIndices = np.argmin(np.abs(notes[:, np.newaxis] - allowedNotes[np.newaxis, :]), axis=1)
+      lookupTable = noteToFrequency(allowedNotes[nearestNoteIndices])
+    else:
+      raise ValueError("Unknown mapping type '"+mappingType+"' for "+outputName)
+
+    return inputMin, inputMax, isLog, lookupTable
+
+  def mapValues(self, instrumentIndex, values):
+    """Compute output parameters from input values (dict of parameter name -> value).
+    Returns dict of output name -> value, containing only those outputs that have changed.
+    """
+    outputValues = {}
+    # Missing values are not mapped
+    values = {name: value for name, value in values.items() if not math.isnan(value)}
+
+    mappingIndices = [mappingIndex for mappingIndex, inputName in enumerate(self.lookupInputNames) if inputName in values]
+    if mappingIndices:
+      mappingIndices = np.array(mappingIndices)
+      inputValues = np.array([values[self.lookupInputNames[mappingIndex]] for mappingIndex in mappingIndices], dtype=float)
+      isLog = self.inputIsLog[mappingIndices]
+      inputValues[isLog] = np.log(np.maximum(inputValues[isLog], np.finfo(float).tiny))
+      sampleIndices = np.rint((inputValues - self.inputMins[mappingIndices]) * self.inputScales[mappingIndices])
+      sampleIndices = np.clip(np.nan_to_num(sampleIndices), 0, self.lookupTableSize - 1).astype(int)
+      mappedValues = self.lookupTable[self.lookupTableOffsets[mappingIndices] + sampleIndices]
+      for mappingIndex, mappedValue in zip(mappingIndices, mappedValues):
+        outputValues[self.lookupOutputNames[mappingIndex]] = float(mappedValue)
+
+    for outputName, zoneMapping in self.zoneMappings.items():
+      if zoneMapping["input"] not in values:
+        continue
+      outputValues[outputName] = zoneMapping["values"][self.updateZone(instrumentIndex, outputName, zoneMapping, values[zoneMapping["input"]])]
+
+    changedOutputValues = {}
+    for outputName, outputValue in outputValues.items():
+      key = (instrumentIndex, outputName)
+      if self.lastOutputValues.get(key) == outputValue:
+        continue
+      self.lastOutputValues[key] = outputValue
+      changedOutputValues[outputName] = outputValue
+    return changedOutputValues
+
+  def updateZone(self, instrumentIndex, outputName, zoneMapping, inputValue):
+    key = (instrumentIndex, outputName)
+    thresholds = zoneMapping["thresholds"]
+    currentZone = self.currentZones.get(key)
+    if currentZone is None:
+      currentZone = int(np.searchsorted(thresholds, inputValue, side="right"))
+    else:
+      # Zone is only changed if the input is beyond the threshold by more than the hysteresis
+      zoneAbove = int(np.searchsorted(thresholds + zoneMapping["hysteresis"], inputValue, side="right"))
+      zoneBelow = int(np.searchsorted(thresholds - zoneMapping["hysteresis"], inputValue, side="right"))
+      if zoneAbove > currentZone:
+        currentZone = zoneAbove
+      elif zoneBelow < currentZone:
+        currentZone = zoneBelow
+    self.currentZones[key] = currentZone
+    return currentZone
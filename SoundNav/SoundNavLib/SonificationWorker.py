@@ -0,0 +1,440 @@
+"""Sonification worker that runs in a separate process.
+
+SoundNav module writes raw instrument matrices and distances into a shared-memory ring buffer
+(SonificationRingBuffer). The worker process reads the buffer, computes sound parameters,
+applies filtering, and sends them to the OSC server. This way sound feedback is not delayed
+by rendering, scene loading, or garbage collection in the application main thread.
+
+The ring buffer has a single producer (SoundNav) and a single consumer (the worker), therefore
+no locking is used: only the producer modifies the write index and only the consumer modifies the read index.
+If the ring buffer is full then the record is written into a "latest value" slot of the instrument instead,
+so that the most recent position of each instrument is never lost.
+
+Indices and sequence numbers are published with plain numpy stores, without memory barriers.
+This relies on the CPU not reordering stores (and loads) with each other, which holds on x86/x86-64.
+On weakly ordered CPUs (e.g., arm64) the worker may occasionally read a record that is not completely
+written yet. STRONG_MEMORY_ORDERING tells if the current CPU is known to provide the required ordering.
+
+Priority classes and message budget of OpenSoundControlLogic are not applied in worker mode:
+the worker sends all values as soon as they are computed.
+
+Usage:
+  PythonSlicer SonificationWorker.py --shared-memory-name <name> --host localhost --port 7400 --addresses '["/SoundNav/Instrument/"]'
+"""
+
+import json
+import math
+import os
+import platform
+import sys
+import time
+import numpy as np
+
+try:
+  from SoundNavLib import ParameterMapping
+except ImportError:
+  # Running as a script, the module is in the same directory
+  import ParameterMapping
+
+# Record types
+RECORD_TYPE_TRANSFORM = 0
+RECORD_TYPE_DISTANCE = 1
+
+# Parameters computed from the instrument to reference transform
+TRANSFORM_PARAMETER_NAMES = ["TranslationX", "TranslationY", "TranslationZ", "Distance",
+  "OrientationX", "OrientationY", "OrientationZ", "Orientation"]
+
+# Metrics relative to planned trajectory and landmarks, computed by SoundNav module
+PLAN_METRIC_NAMES = ["TrajectoryDistance", "TrajectoryDepth", "TrajectoryAngle", "LandmarkDistance", "LandmarkIndex"]
+
+# Record layout (float64 values)
+RECORD_TIMESTAMP = 0
+RECORD_INSTRUMENT_INDEX = 1
+RECORD_TYPE = 2
+RECORD_MATRIX = 3  # 16 values, row-major instrument to reference matrix
+RECORD_DISTANCE = 19
+RECORD_PLAN_METRICS = 20
+RECORD_SIZE = RECORD_PLAN_METRICS + len(PLAN_METRIC_NAMES)
+
+# Integer header fields
+HEADER_WRITE_INDEX = 0
+HEADER_READ_INDEX = 1
+HEADER_DROPPED_COUNT = 2
+HEADER_PROCESSED_COUNT = 3  # number of records read and processed by the worker
+HEADER_STOP_REQUESTED = 4
+HEADER_CAPACITY = 5
+HEADER_NUMBER_OF_INSTRUMENTS = 6
+HEADER_SENT_COUNT = 7
+HEADER_SIZE = 8
+
+# Floating-point status fields
+STATUS_WORKER_HEARTBEAT = 0
+STATUS_LAST_LATENCY = 1
+STATUS_LATENCY_SUM = 2
+STATUS_MAX_LATENCY = 3
+STATUS_SIZE = 8
+
+# Store order is preserved between processes on these CPUs, which is required by SonificationRingBuffer
+STRONG_MEMORY_ORDERING = platform.machine().lower() in ["x86_64", "amd64", "x86", "i386", "i686"]
+
+# Worker checks this often if the application that started it is still running
+PARENT_CHECK_INTERVAL_SEC = 1.0
+
+# Angles that wrap around at +/-180 degrees
+WRAPPING_ANGLE_NAMES = ["OrientationX", "OrientationY", "OrientationZ"]
+
+# Rotation parameters are not computed if vector length is smaller than this
+AXIS_EPSILON = 0.001
+
+
+class SonificationRingBuffer:
+  """Single-producer single-consumer ring buffer of fixed-size float64 records in shared memory.
+  It does not use memory barriers, see STRONG_MEMORY_ORDERING.
+  Timestamps are time.perf_counter() values, which use a system-wide clock on all supported platforms.
+  """
+
+  def __init__(self, name=None, capacity=1024, numberOfInstruments=8):
+    """Create a new shared memory buffer (if name is None) or attach to an existing one.
+    """
+    from multiprocessing import shared_memory
+    headerBytes = HEADER_SIZE * 8 + STATUS_SIZE * 8
+    if name is None:
+      latestBytes = numberOfInstruments * (RECORD_SIZE + 1) * 8
+      self.sharedMemory = shared_memory.SharedMemory(create=True, size=headerBytes + latestBytes + capacity * RECORD_SIZE * 8)
+      self.owner = True
+    else:
+      self.sharedMemory = shared_memory.SharedMemory(name=name)
+      self.owner = False
+      # The buffer is owned by the producer, prevent the resource tracker from removing it when the worker exits
+      try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(self.sharedMemory._name, "shared_memory")
+      except Exception:
+        pass
+    self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.sharedMemory.buf, offset=0)
+    self.status = np.ndarray((STATUS_SIZE,), dtype=np.float64, buffer=self.sharedMemory.buf, offset=HEADER_SIZE * 8)
+    if self.owner:
+      self.header[:] = 0
+      self.status[:] = 0
+      self.header[HEADER_CAPACITY] = capacity
+      self.header[HEADER_NUMBER_OF_INSTRUMENTS] = numberOfInstruments
+    self.capacity = int(self.header[HEADER_CAPACITY])
+    self.numberOfInstruments = int(self.header[HEADER_NUMBER_OF_INSTRUMENTS])
+    # Latest value slot of each instrument, used when the ring buffer is full.
+    # The sequence number is odd while the slot is being written and it is incremented by 2 on each write.
+    offset = headerBytes
+    self.latestSequences = np.ndarray((self.numberOfInstruments,), dtype=np.int64, buffer=self.sharedMemory.buf, offset=offset)
+    offset += self.numberOfInstruments * 8
+    self.latestRecords = np.ndarray((self.numberOfInstruments, RECORD_SIZE), dtype=np.float64, buffer=self.sharedMemory.buf, offset=offset)
+    offset += self.numberOfInstruments * RECORD_SIZE * 8
+    self.records = np.ndarray((self.capacity, RECORD_SIZE), dtype=np.float64, buffer=self.sharedMemory.buf, offset=offset)
+    if self.owner:
+      self.latestSequences[:] = 0
+    # Sequence number of the latest value slots that have been read already (used by the consumer)
+    self.readLatestSequences = np.array(self.latestSequences)
+
+  @property
+  def name(self):
+    return self.sharedMemory.name
+
+  def close(self):
+    # numpy views must be released before the shared memory can be closed
+    self.header = None
+    self.status = None
+    self.latestSequences = None
+    self.latestRecords = None
+    self.records = None
+    self.sharedMemory.close()
+    if self.owner:
+      self.sharedMemory.unlink()
+
+  def write(self, record):
+    """Add a record to the buffer. If the ring buffer is full then the record replaces
+    the previous value in the latest value slot of the instrument and False is returned.
+    """
+    writeIndex = int(self.header[HEADER_WRITE_INDEX])
+    if writeIndex - int(self.header[HEADER_READ_INDEX]) >= self.capacity:
+      instrumentIndex = int(record[RECORD_INSTRUMENT_INDEX])
+      if 0 <= instrumentIndex < self.numberOfInstruments:
+        sequence = int(self.latestSequences[instrumentIndex])
+        self.latestSequences[instrumentIndex] = sequence + 1
+        self.latestRecords[instrumentIndex] = record
+        self.latestSequences[instrumentIndex] = sequence + 2
+      return False
+    self.records[writeIndex % self.capacity] = record
+    # Publish the record only after it is completely written
+    self.header[HEADER_WRITE_INDEX] = writeIndex + 1
+    return True
+
+  def readAll(self):
+    """Get copy of all records that have not been read yet, in the order they were written.
+    """
+    readIndex = int(self.header[HEADER_READ_INDEX])
+    writeIndex = int(self.header[HEADER_WRITE_INDEX])
+    records = self.records[np.arange(readIndex, writeIndex) % self.capacity]
+    self.header[HEADER_READ_INDEX] = writeIndex
+
+    latestRecords = []
+    for instrumentIndex in range(self.numberOfInstruments):
+      sequence = int(self.latestSequences[instrumentIndex])
+      if sequence == self.readLatestSequences[instrumentIndex] or sequence % 2:
+        # Not changed or currently being written (it will be read next time)
+        continue
+      record = self.latestRecords[instrumentIndex].copy()
+      if int(self.latestSequences[instrumentIndex]) != sequence:
+        # Modified while copying, it will be read next time
+        continue
+      # Values that were replaced in the slot before they could be read are lost
+      self.header[HEADER_DROPPED_COUNT] += (sequence - self.readLatestSequences[instrumentIndex]) // 2 - 1
+      self.readLatestSequences[instrumentIndex] = sequence
+      latestRecords.append(record)
+    if latestRecords:
+      records = np.concatenate([records, latestRecords])
+      records = records[np.argsort(records[:, RECORD_TIMESTAMP], kind="stable")]
+    return records
+
+  def getMetrics(self):
+    """Get health and backlog metrics of the worker.
+    """
+    sentCount = int(self.header[HEADER_SENT_COUNT])
+    return {
+      "backlog": int(self.header[HEADER_WRITE_INDEX] - self.header[HEADER_READ_INDEX]),
+      "droppedCount": int(self.header[HEADER_DROPPED_COUNT]),
+      "processedCount": int(self.header[HEADER_PROCESSED_COUNT]),
+      "sentCount": sentCount,
+      "workerHeartbeatAgeSec": time.perf_counter() - self.status[STATUS_WORKER_HEARTBEAT] if self.status[STATUS_WORKER_HEARTBEAT] else None,
+      "lastLatencySec": float(self.status[STATUS_LAST_LATENCY]),
+      "meanLatencySec": float(self.status[STATUS_LATENCY_SUM]) / sentCount if sentCount else 0.0,
+      "maxLatencySec": float(self.status[STATUS_MAX_LATENCY]),
+      }
+
+
+def isProcessRunning(processId):
+  if sys.platform == "win32":
+    import ctypes
+    SYNCHRONIZE = 0x00100000
+    WAIT_TIMEOUT = 0x00000102
+    kernel32 = ctypes.windll.kernel32
+    processHandle = kernel32.OpenProcess(SYNCHRONIZE, False, processId)
+    if not processHandle:
+      return False
+    try:
+      return kernel32.WaitForSingleObject(processHandle, 0) == WAIT_TIMEOUT
+    finally:
+      kernel32.CloseHandle(processHandle)
+  try:
+    os.kill(processId, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
+
+
+def makeRecord(timestamp, instrumentIndex, recordType, matrix=None, distance=math.nan, planMetrics=None):
+  """Create a record. matrix is a 4x4 numpy array, planMetrics is a dict with keys from PLAN_METRIC_NAMES.
+  """
+  record = np.full(RECORD_SIZE, np.nan)
+  record[RECORD_TIMESTAMP] = timestamp
+  record[RECORD_INSTRUMENT_INDEX] = instrumentIndex
+  record[RECORD_TYPE] = recordType
+  if matrix is not None:
+    record[RECORD_MATRIX:RECORD_MATRIX+16] = np.asarray(matrix).ravel()
+  record[RECORD_DISTANCE] = distance
+  if planMetrics:
+    for metricIndex, metricName in enumerate(PLAN_METRIC_NAMES):
+      if metricName in planMetrics:
+        record[RECORD_PLAN_METRICS + metricIndex] = planMetrics[metricName]
+  return record
+
+
+def computeTransformFeatures(matrices):
+  """Compute translation, distance, and orientation parameters for an array of 4x4 matrices.
+  Orientation angles are computed the same way as in vtkTransform::GetOrientation (rotation order: Y, X, Z).
+  Returns dict of parameter name -> array of values.
+  """
+  translation = matrices[:, 0:3, 3]
+  # Remove scaling
+  rotation = matrices[:, 0:3, 0:3] / np.linalg.norm(matrices[:, 0:3, 0:3], axis=1)[:, np.newaxis, :]
+
+  # first rotate about y axis
+  x2, y2, z2 = rotation[:, 2, 0], rotation[:, 2, 1], rotation[:, 2, 2]
+  x3, y3, z3 = rotation[:, 1, 0], rotation[:, 1, 1], rotation[:, 1, 2]
+  d1 = np.sqrt(x2*x2 + z2*z2)
+  d1Valid = d1 >= AXIS_EPSILON
+  safeD1 = np.where(d1Valid, d1, 1.0)
+  cosTheta = np.where(d1Valid, z2 / safeD1, 1.0)
+  sinTheta = np.where(d1Valid, x2 / safeD1, 0.0)
+  theta = np.arctan2(sinTheta, cosTheta)
+
+  # now rotate about x axis
+  d = np.sqrt(x2*x2 + y2*y2 + z2*z2)
+  dValid = d >= AXIS_EPSILON
+  safeD = np.where(dValid, d, 1.0)
+  sinPhi = np.where(dValid, y2 / safeD, 0.0)
+  cosPhi = np.where(dValid, np.where(d1Valid, (x2*x2 + z2*z2) / (safeD1 * safeD), z2 / safeD), 1.0)
+  phi = np.arctan2(sinPhi, cosPhi)
+
+  # finally, rotate about z
+  x3p = x3 * cosTheta - z3 * sinTheta
+  y3p = -sinPhi * sinTheta * x3 + cosPhi * y3 - sinPhi * cosTheta * z3
+  d2 = np.sqrt(x3p*x3p + y3p*y3p)
+  d2Valid = d2 >= AXIS_EPSILON
+  safeD2 = np.where(d2Valid, d2, 1.0)
+  cosAlpha = np.where(d2Valid, y3p / safeD2, 1.0)
+  sinAlpha = np.where(d2Valid, x3p / safeD2, 0.0)
+  alpha = np.arctan2(sinAlpha, cosAlpha)
+
+  # rotation angle (W component of WXYZ orientation)
+  trace = rotation[:, 0, 0] + rotation[:, 1, 1] + rotation[:, 2, 2]
+  rotationAngle = np.degrees(np.arccos(np.clip((trace - 1.0) / 2.0, -1.0, 1.0)))
+
+  return {
+    "TranslationX": translation[:, 0],
+    "TranslationY": translation[:, 1],
+    "TranslationZ": translation[:, 2],
+    "Distance": np.linalg.norm(translation, axis=1),
+    "OrientationX": np.degrees(phi),
+    "OrientationY": -np.degrees(theta),
+    "OrientationZ": np.degrees(alpha),
+    "Orientation": rotationAngle,
+    }
+
+
+class SonificationWorker:
+  """Reads records from the ring buffer, computes sound parameters, and sends them to the OSC server.
+  """
+
+  def __init__(self, ringBuffer, oscClient, instrumentOscAddresses, smoothingFactor=1.0, parameterMapper=None):
+    self.ringBuffer = ringBuffer
+    self.oscClient = oscClient
+    self.instrumentOscAddresses = instrumentOscAddresses
+    # Weight of the new value in exponential smoothing (1.0 means no smoothing)
+    self.smoothingFactor = smoothingFactor
+    # Key is (instrument index, parameter name)
+    self.smoothedValues = {}
+    # Transfer functions that compute sound parameters from the values
+    self.parameterMapper = parameterMapper
+
+  def filterValue(self, instrumentIndex, parameterName, value):
+    if self.smoothingFactor >= 1.0 or parameterName == "LandmarkIndex":
+      return value
+    key = (instrumentIndex, parameterName)
+    previousValue = self.smoothedValues.get(key)
+    if previousValue is not None:
+      if parameterName in WRAPPING_ANGLE_NAMES:
+        # Smooth along the shortest arc and keep the result in the [-180, 180) range
+        difference = (value - previousValue + 180.0) % 360.0 - 180.0
+        value = (previousValue + self.smoothingFactor * difference + 180.0) % 360.0 - 180.0
+      else:
+        value = previousValue + self.smoothingFactor * (value - previousValue)
+    self.smoothedValues[key] = value
+    return value
+
+  def processRecords(self, records):
+    """Process a batch of records. If there are multiple records for the same instrument
+    then all of them are used for filtering but only the latest values are sent.
+    """
+    if len(records) == 0:
+      return
+
+    recordValues = []  # parameter values of each record
+    transformRecords = records[:, RECORD_TYPE] == RECORD_TYPE_TRANSFORM
+    if np.any(transformRecords):
+      matrices = records[transformRecords, RECORD_MATRIX:RECORD_MATRIX+16].reshape(-1, 4, 4)
+      transformFeatures = computeTransformFeatures(matrices)
+    transformRecordIndex = 0
+    for record, isTransformRecord in zip(records, transformRecords):
+      values = {}
+      if isTransformRecord:
+        for parameterName, featureValues in transformFeatures.items():
+          values[parameterName] = featureValues[transformRecordIndex]
+        transformRecordIndex += 1
+      elif not math.isnan(record[RECORD_DISTANCE]):
+        values["Distance"] = record[RECORD_DISTANCE]
+      for metricIndex, metricName in enumerate(PLAN_METRIC_NAMES):
+        metricValue = record[RECORD_PLAN_METRICS + metricIndex]
+        if not math.isnan(metricValue):
+          values[metricName] = metricValue
+      recordValues.append(values)
+
+    latestRecords = {}
+    for record, values in zip(records, recordValues):
+      instrumentIndex = int(record[RECORD_INSTRUMENT_INDEX])
+      for parameterName in values:
+        values[parameterName] = self.filterValue(instrumentIndex, parameterName, values[parameterName])
+      latestRecords[instrumentIndex] = (record, values)
+
+    for instrumentIndex, (record, values) in latestRecords.items():
+      if instrumentIndex >= len(self.instrumentOscAddresses):
+        continue
+      address = self.instrumentOscAddresses[instrumentIndex]
+      timestamp = record[RECORD_TIMESTAMP]
+      for parameterName, value in values.items():
+        if parameterName == "LandmarkIndex":
+          self.sendMessage(address+parameterName, int(value), timestamp)
+        else:
+          self.sendMessage(address+parameterName, float(value), timestamp)
+      if self.parameterMapper:
+        # Mapped values are only sent if they have changed
+        for outputName, outputValue in self.parameterMapper.mapValues(instrumentIndex, values).items():
+          self.sendMessage(address+outputName, outputValue, timestamp)
+    self.ringBuffer.header[HEADER_PROCESSED_COUNT] += len(records)
+
+  def sendMessage(self, address, value, timestamp):
+    """Send message and update latency metrics (time from instrument update until the message is sent).
+    """
+    self.oscClient.send_message(address, value)
+    latency = time.perf_counter() - timestamp
+    status = self.ringBuffer.status
+    status[STATUS_LAST_LATENCY] = latency
+    status[STATUS_LATENCY_SUM] += latency
+    status[STATUS_MAX_LATENCY] = max(status[STATUS_MAX_LATENCY], latency)
+    self.ringBuffer.header[HEADER_SENT_COUNT] += 1
+
+  def run(self, parentProcessId=None, pollIntervalSec=0.0005):
+    """Process records until stop is requested or the parent process exits.
+    The worker keeps running while the parent process is busy (e.g., loading a scene).
+    """
+    lastParentCheckTime = time.perf_counter()
+    while not self.ringBuffer.header[HEADER_STOP_REQUESTED]:
+      currentTime = time.perf_counter()
+      self.ringBuffer.status[STATUS_WORKER_HEARTBEAT] = currentTime
+      if parentProcessId and currentTime - lastParentCheckTime > PARENT_CHECK_INTERVAL_SEC:
+        lastParentCheckTime = currentTime
+        if not isProcessRunning(parentProcessId):
+          break
+      records = self.ringBuffer.readAll()
+      if len(records) == 0:
+        time.sleep(pollIntervalSec)
+        continue
+      self.processRecords(records)
+
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description="Sonification worker that sends OSC messages based on navigation data")
+  parser.add_argument("--shared-memory-name", required=True)
+  parser.add_argument("--host", default="localhost")
+  parser.add_argument("--port", type=int, default=7400)
+  parser.add_argument("--addresses", required=True, help="JSON list of OSC address prefix of each instrument")
+  parser.add_argument("--smoothing-factor", type=float, default=1.0)
+  parser.add_argument("--mappings", default="{}", help="JSON dict of transfer functions (see ParameterMapping.py)")
+  parser.add_argument("--parent-pid", type=int, default=None, help="Worker exits when this process is no longer running")
+  args = parser.parse_args()
+
+  from pythonosc.udp_client import SimpleUDPClient
+  mappingDefinitions = json.loads(args.mappings)
+  parameterMapper = ParameterMapping.ParameterMapper(mappingDefinitions) if mappingDefinitions else None
+  ringBuffer = SonificationRingBuffer(name=args.shared_memory_name)
+  try:
+    worker = SonificationWorker(ringBuffer, SimpleUDPClient(args.host, args.port), json.loads(args.addresses),
+      args.smoothing_factor, parameterMapper)
+    worker.run(args.parent_pid)
+  finally:
+    worker = None
+    ringBuffer.close()
+
+
+if __name__ == "__main__":
+  main()